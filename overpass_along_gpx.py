@@ -2,28 +2,69 @@
 """Query Overpass API along GPX files and write the result to a GPX file"""
 
 import argparse
+import base64
+import gzip
+import hashlib
 import http.client
-import json
+import itertools
 import math
+import mmap
+import os
+import queue
 import re
 import sys
+import threading
 import time
 import urllib.parse
 import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+try:
+    # considerably faster than the json module for large responses, but optional
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+_POINT_RE = re.compile(rb'<(?:trkpt|wpt|rtept)\b([^>]*)>')
+_LAT_RE = re.compile(rb'\blat="(-?\d+(?:\.\d+)?)"')
+_LON_RE = re.compile(rb'\blon="(-?\d+(?:\.\d+)?)"')
+
+# names of cached responses and their temporary files, see get_cache_file()
+_CACHE_FILE_RE = re.compile(r'[0-9a-f]{64}\.json(?:\.\d+\.\d+\.tmp)?')
+
+# GPX output templates, formatted as bytes since everything apart from the title is ASCII.
+# Coordinates use fixed-point notation (%.*f) as GPX doesn't allow exponents.
+_WPT_TEMPLATE = (
+    b' <wpt lat="%.*f" lon="%.*f">\n'
+    b'  <extensions>\n'
+    b'   <osmid>%d</osmid>\n'
+    b'  </extensions>\n'
+    b' </wpt>\n')
+_TRKPT_TEMPLATE = b'   <trkpt lat="%.*f" lon="%.*f"></trkpt>\n'
+_TRK_TEMPLATE = (
+    b' <trk>\n'
+    b'  <trkseg>\n'
+    b'%b'
+    b'  </trkseg>\n'
+    b'  <extensions>\n'
+    b'   <osmid>%d</osmid>\n'
+    b'  </extensions>\n'
+    b' </trk>\n')
 
 @dataclass
 class Location:
     """Location consisting of latitude and longitude"""
 
+    # no per-instance __dict__, there is one instance per GPX point and way vertex
+    __slots__ = ('lat', 'lon')
+
     lat: float
     lon: float
 
-    def str(self):
-        """Return a string represenation of this location"""
-
-        return f'{self.lat},{self.lon}'
-
 @dataclass
 class OverpassAlongGPX:
     """Query Overpass API along GPX files and write the result to a GPX file
@@ -33,24 +74,40 @@ class OverpassAlongGPX:
         limit (int): Maximum number of locations per Overpass API query
         retries (int): Number of retries if call to Overpass API fails
         verbose (int): Verbosity level
+        parallel (int): Maximum number of Overpass API queries to perform in parallel
+        precision (int): Maximum number of decimal places of coordinates in queries and output
+        cache_dir (str): Directory to cache Overpass API responses in, None to disable caching
+        cache_ttl (float): Maximum age of cached Overpass API responses in days
+        thin (float): Minimum distance in meters between consecutive locations, 0 to keep all
         locations_in (list): List of locations obtained from GPX input file
         nodes_out (list): Nodes obtained from Overpass API result
         ways_out (list): Ways obtained from Overpass API result
         node_ids (set): Unique OSM IDs of all ways obtained from Overpass API result
         way_ids (set): Unique OSM IDs of all ways obtained from Overpass API result
         failure (bool): Whether call to Overpass API failed even after retry
+        connections (SimpleQueue): Idle persistent connections to Overpass API, reused for all
+            queries
+        stopping (Event): Set to make parallel queries stop after their current try
     """
 
     url: str
     limit: int = 0
     retries: int = 0
     verbose: int = 0
+    parallel: int = 1
+    precision: int = 6
+    cache_dir: str = None
+    cache_ttl: float = 7
+    thin: float = 0
     locations_in: list = field(default_factory=list)
     nodes_out: list = field(default_factory=list)
     ways_out: list = field(default_factory=list)
     node_ids: set = field(default_factory=set)
     way_ids: set = field(default_factory=set)
     failure: bool = False
+    connections: queue.SimpleQueue = field(default_factory=queue.SimpleQueue, init=False,
+        repr=False)
+    stopping: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
 
     @dataclass
     class Node:
@@ -61,6 +118,8 @@ class OverpassAlongGPX:
             loc (Location): Coordinates
         """
 
+        __slots__ = ('id', 'loc')
+
         id: int
         loc: Location
 
@@ -73,83 +132,120 @@ class OverpassAlongGPX:
             nodes (list): A list of locations 
         """
 
+        __slots__ = ('id', 'nodes')
+
         id: int
-        nodes: list = field(default_factory=list)
+        nodes: list
 
-        def add_node(self, location):
-            """Add a node to this way"""
-            self.nodes.append(location)
+    def format_coordinate(self, value):
+        """Return coordinate for Overpass API query with at most the configured decimal places
 
-    def write_header(self, out, title):
-        """Add GPX header"""
+        GPS isn't more accurate than ~1e-6 degrees anyway, so there is no point in sending 17
+        significant digits. Trailing zeros are stripped to keep the query short. Unlike str(),
+        this never yields exponent notation.
+        """
 
-        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        out.write('<gpx\n')
-        out.write(' xmlns="http://www.topografix.com/GPX/1/1"\n')
-        out.write(' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"\n')
-        out.write(' xsi:schemaLocation="http://www.topografix.com/GPX/1/1 '
-            'http://www.topografix.com/GPX/1/1/gpx.xsd"\n')
-        out.write(' version="1.1"\n')
-        out.write(' creator="overpass_along_gpx">\n')
+        text = f'{value:.{self.precision}f}'
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if '-0' == text:
+            text = '0'
+        return text
+
+    def format_header(self, title):
+        """Return GPX header"""
+
+        header = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n'
+            b'<gpx\n'
+            b' xmlns="http://www.topografix.com/GPX/1/1"\n'
+            b' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"\n'
+            b' xsi:schemaLocation="http://www.topografix.com/GPX/1/1 '
+            b'http://www.topografix.com/GPX/1/1/gpx.xsd"\n'
+            b' version="1.1"\n'
+            b' creator="overpass_along_gpx">\n')
 
         if title:
-            out.write(f' <title>{title}</title>\n')
-
-    def write_footer(self, out):
-        """Add GPX trailer"""
-
-        out.write('</gpx>\n')
-
-    def write_node(self, out, node):
-        """Write node to GPX"""
-
-        out.write((
-            f' <wpt lat="{node.loc.lat}" lon="{node.loc.lon}">\n'
-            '  <extensions>\n'
-            f'   <osmid>{node.id}</osmid>\n'
-            '  </extensions>\n'
-            ' </wpt>\n'))
-
-    def write_way(self, out, way):
-        """Write way to GPX"""
-
-        out.write((
-            ' <trk>\n'
-            '  <trkseg>\n'))
-        for node in way.nodes:
-            out.write(f'   <trkpt lat="{node.lat}" lon="{node.lon}"></trkpt>\n')
-        out.write((
-            '  </trkseg>\n'
-            '  <extensions>\n'
-            f'   <osmid>{way.id}</osmid>\n'
-            '  </extensions>\n'
-            ' </trk>\n'))
+            # the title is the only part of the output which may contain non-ASCII characters
+            header += f' <title>{escape(title)}</title>\n'.encode('utf-8')
+        return header
+
+    def format_footer(self):
+        """Return GPX trailer"""
+
+        return b'</gpx>\n'
+
+    def format_node(self, node):
+        """Return node as GPX waypoint"""
+
+        prec = self.precision
+        return _WPT_TEMPLATE % (prec, node.loc.lat, prec, node.loc.lon, node.id)
+
+    def format_way(self, way):
+        """Return way as GPX track"""
+
+        prec = self.precision
+        trkpts = b''.join([_TRKPT_TEMPLATE % (prec, node.lat, prec, node.lon)
+                           for node in way.nodes])
+        return _TRK_TEMPLATE % (trkpts, way.id)
+
+    def scan_gpx_file(self, file):
+        """Obtain locations from given GPX file by scanning it for point elements
+
+        Slower fallback for files that aren't well-formed XML, e.g. truncated recordings. The file
+        is memory-mapped and scanned as bytes, so there is no per-line decoding.
+        """
+
+        locations = []
+        append = locations.append
+        with open(file, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return locations
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for match in _POINT_RE.finditer(data):
+                    attributes = match.group(1)
+                    lat = _LAT_RE.search(attributes)
+                    if not lat:
+                        continue
+                    lon = _LON_RE.search(attributes)
+                    if not lon:
+                        continue
+
+                    append(Location(float(lat.group(1)), float(lon.group(1))))
+        return locations
 
     def parse_gpx_file(self, file):
         """Obtain locations from given GPX file"""
 
         print(f'Parsing {file}')
-        with open(file, encoding='utf-8') as infile:
-            for line in infile:
-                if not any(word in line for word in('<trkpt', '<wpt', '<rtept')):
-                    continue
-                if not 'lat="' in line and 'lon="' in line:
-                    continue
-
-                lat = re.search('lat="\\d+\\.\\d+"', line)
-                if not lat:
+        locations = []
+        append = locations.append
+        try:
+            # track open elements to be able to detach finished ones from their parent
+            parents = []
+            for event, elem in ElementTree.iterparse(file, events=('start', 'end')):
+                if 'start' == event:
+                    parents.append(elem)
                     continue
-                lat = lat.group(0) # lat='lat="51.12345"'
-                lat = float(lat.split('"')[1])
-
-                lon = re.search('lon="\\d+\\.\\d+"', line)
-                if not lon:
-                    continue
-                lon = lon.group(0) # lon='lon="13.67890"'
-                lon = float(lon.split('"')[1])
-
-                location = Location(lat, lon)
-                self.locations_in.append(location)
+                parents.pop()
+
+                # strip namespace, e.g. '{http://www.topografix.com/GPX/1/1}trkpt'
+                tag = elem.tag.rsplit('}', 1)[-1]
+                if tag in ('trkpt', 'wpt', 'rtept'):
+                    lat = elem.get('lat')
+                    lon = elem.get('lon')
+                    if lat is not None and lon is not None:
+                        append(Location(float(lat), float(lon)))
+
+                # drop finished elements so that memory usage doesn't grow with the file size,
+                # each parent only ever holds the one child that just ended
+                if parents:
+                    parents[-1].remove(elem)
+        except ElementTree.ParseError as ex:
+            print(f'Failed to parse {file} as XML ({ex}), falling back to scanning')
+            locations = self.scan_gpx_file(file)
+
+        self.locations_in.extend(locations)
         if self.verbose:
             print(f'Read {len(self.locations_in)} locations')
 
@@ -159,13 +255,15 @@ class OverpassAlongGPX:
         if self.verbose:
             print(f'Writing result to {file}')
 
-        with open(file, 'w', encoding='utf-8') as outfile:
-            self.write_header(outfile, title)
-            for node in self.nodes_out:
-                self.write_node(outfile, node)
-            for way in self.ways_out:
-                self.write_way(outfile, way)
-            self.write_footer(outfile)
+        # assemble the whole document first and write it at once instead of issuing many small
+        # writes for each node and way
+        parts = [self.format_header(title)]
+        parts.extend([self.format_node(node) for node in self.nodes_out])
+        parts.extend([self.format_way(way) for way in self.ways_out])
+        parts.append(self.format_footer())
+
+        with open(file, 'wb') as outfile:
+            outfile.write(b''.join(parts))
         print('Wrote result')
 
     def read_overpass_queries_from_file(self, file):
@@ -177,130 +275,393 @@ class OverpassAlongGPX:
                 queries.append(line.strip())
         return queries
 
-    def build_overpass_query(self, locations, queries, timeout, distance):
-        """Build and return full Overpass API query"""
+    def build_overpass_query_template(self, queries, timeout, distance):
+        """Build template of the Overpass API query which only lacks the locations
+
+        The template is a list of the static query parts in between which the locations have to
+        be inserted. It only has to be built once for all chunks.
+        """
 
-        latlon = ','.join([loc.str() for loc in locations])
-        query = (
+        template = [
             f'[out:json][timeout:{timeout}];\n'
-            '(\n')
+            '(\n']
         for q in queries:
-            query += f'    {q}(around:{distance},{latlon});\n'
-        query += (
+            template[-1] += f'    {q}(around:{distance},'
+            template.append(');\n')
+        template[-1] += (
             ');\n'
             'out geom;')
 
-        return query
+        return template
+
+    def build_overpass_query(self, locations, template):
+        """Build and return full Overpass API query from template"""
+
+        fmt = self.format_coordinate
+        latlon = ','.join([f'{fmt(loc.lat)},{fmt(loc.lon)}' for loc in locations])
+        return latlon.join(template)
 
     def process_overpass_response(self, jresponse):
         """Process JSON response from Overpass API request"""
 
-        node_count = way_count = 0
+        # bind attributes to locals, responses can contain tens of thousands of elements. New
+        # elements are collected separately and merged into the result in one go at the end.
+        known_node_ids = self.node_ids
+        known_way_ids = self.way_ids
+        new_node_ids = set()
+        new_way_ids = set()
+        new_nodes = []
+        new_ways = []
+        node_class = self.Node
+        way_class = self.Way
+        verbose = self.verbose
+
         for element in jresponse['elements']:
             element_type = element['type']
-            if element_type not in ('node', 'way'):
-                continue
-
-            element_id = element['id']
 
             if 'node' == element_type:
+                element_id = element['id']
                 # check if element already exists, can happen if we perform multiple Overpass API
                 # queries to limit the number of locations per query and the same elements are
                 # returned by subsequent queries
-                if element_id in self.node_ids:
-                    if self.verbose:
+                if element_id in known_node_ids or element_id in new_node_ids:
+                    if verbose:
                         print(f'Skipping previously obtained node {element_id}')
                     continue
 
-                if self.verbose:
+                if verbose:
                     print(f'Adding new node {element_id}')
-                self.node_ids.add(element_id)
-
-                loc = Location(element['lat'], element['lon'])
-                node = self.Node(element_id, loc)
-                self.nodes_out.append(node)
-                node_count += 1
+                new_node_ids.add(element_id)
+                new_nodes.append(node_class(element_id, Location(element['lat'], element['lon'])))
             elif 'way' == element_type:
-                if element_id in self.way_ids:
-                    if self.verbose:
+                element_id = element['id']
+                if element_id in known_way_ids or element_id in new_way_ids:
+                    if verbose:
                         print(f'Skipping previously obtained way {element_id}')
                     continue
 
-                if self.verbose:
+                if verbose:
                     print(f'Adding new way {element_id}')
-                self.way_ids.add(element_id)
-
-                way = self.Way(element_id)
-                for geometry in element['geometry']:
-                    location = Location(geometry['lat'], geometry['lon'])
-                    way.add_node(location)
-                self.ways_out.append(way)
-                way_count += 1
+                new_way_ids.add(element_id)
+                new_ways.append(way_class(element_id, [Location(geometry['lat'], geometry['lon'])
+                                                       for geometry in element['geometry']]))
+
+        known_node_ids |= new_node_ids
+        known_way_ids |= new_way_ids
+        self.nodes_out.extend(new_nodes)
+        self.ways_out.extend(new_ways)
+        node_count = len(new_nodes)
+        way_count = len(new_ways)
         print(f'Obtained {way_count} ways and {node_count} nodes from Overpass API')
 
-    def perform_overpass_query(self, locations, query, timeout, distance, dry_run):
-        """Query Overpass API for given locations"""
+    def get_proxy(self):
+        """Return proxy for Overpass API configured via environment, None if no proxy is used
+
+        Honours HTTP_PROXY, HTTPS_PROXY and NO_PROXY the same way urllib.request does.
+        """
+
+        url = urllib.parse.urlsplit(self.url)
+        proxy = urllib.request.getproxies().get(url.scheme)
+        if not proxy or urllib.request.proxy_bypass(url.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = f'http://{proxy}'
+        return urllib.parse.urlsplit(proxy)
+
+    def get_proxy_headers(self, proxy):
+        """Return headers for authenticating at given proxy"""
+
+        if not proxy or proxy.username is None:
+            return {}
+        credentials = (f'{urllib.parse.unquote(proxy.username)}:'
+                       f'{urllib.parse.unquote(proxy.password or "")}')
+        return {'Proxy-Authorization':
+                'Basic ' + base64.b64encode(credentials.encode()).decode('ascii')}
+
+    def get_interpreter_path(self, proxy):
+        """Return path of the Overpass API interpreter endpoint
+
+        Plain HTTP proxies expect the absolute URL instead of only the path.
+        """
+
+        url = urllib.parse.urlsplit(self.url)
+        path = url.path.rstrip('/') + '/interpreter'
+        if proxy and 'http' == url.scheme:
+            return f'{url.scheme}://{url.netloc}{path}'
+        return path
+
+    def acquire_connection(self, timeout):
+        """Return an idle persistent connection to Overpass API, open a new one if necessary
+
+        Keeping connections alive avoids a new TCP and TLS handshake for each query.
+        """
+
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        url = urllib.parse.urlsplit(self.url)
+        proxy = self.get_proxy()
+        # give Overpass API some slack on top of the query timeout, e.g. for queuing
+        timeout += 30
+        if 'http' == url.scheme:
+            # plain HTTP requests are simply sent to the proxy
+            host = proxy.netloc.rpartition('@')[2] if proxy else url.netloc
+            return http.client.HTTPConnection(host, timeout=timeout)
+        if not proxy:
+            return http.client.HTTPSConnection(url.netloc, timeout=timeout)
+        # HTTPS is tunneled through the proxy via CONNECT
+        connection = http.client.HTTPSConnection(proxy.netloc.rpartition('@')[2], timeout=timeout)
+        connection.set_tunnel(url.hostname, url.port, headers=self.get_proxy_headers(proxy))
+        return connection
+
+    def release_connection(self, connection):
+        """Return connection to the pool of idle connections"""
+
+        self.connections.put(connection)
+
+    def close_connections(self):
+        """Close all idle persistent connections to Overpass API"""
+
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def send_overpass_request(self, post_data, timeout):
+        """Send request to Overpass API, return response and its decompressed body
+
+        Idle keep-alive connections may have been closed by the server in the meantime. In this
+        case the request is repeated on another connection instead of failing the try.
+        """
+
+        proxy = self.get_proxy()
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Accept-Encoding': 'gzip'}
+        if 'http' == urllib.parse.urlsplit(self.url).scheme:
+            headers.update(self.get_proxy_headers(proxy))
+
+        while True:
+            connection = self.acquire_connection(timeout)
+            reused = connection.sock is not None
+            try:
+                connection.request('POST', self.get_interpreter_path(proxy), body=post_data,
+                    headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                if not reused:
+                    raise
+                if self.verbose:
+                    print('Idle connection to Overpass API was closed, reconnecting')
+                continue
+            except Exception:
+                # connection is in an unknown state, don't reuse it
+                connection.close()
+                raise
+            self.release_connection(connection)
+
+            if 'gzip' == response.getheader('Content-Encoding'):
+                body = gzip.decompress(body)
+            return response, body
+
+    def get_cache_file(self, full_query):
+        """Return cache file for given Overpass API query, None if caching is disabled"""
+
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256(f'{self.url}\n{full_query}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def prune_cache(self):
+        """Remove expired responses and leftover temporary files from cache directory"""
+
+        if not self.cache_dir:
+            return
+        max_age = self.cache_ttl * 24 * 60 * 60
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            # cache directory doesn't exist yet
+            return
+        for entry in entries:
+            # never touch files which weren't created by the cache, e.g. if the cache directory
+            # points to a data folder
+            if not _CACHE_FILE_RE.fullmatch(entry.name):
+                continue
+            try:
+                if now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def read_cached_response(self, cache_file):
+        """Return cached JSON response from cache file, None if missing or expired"""
+
+        if not cache_file:
+            return None
+        try:
+            age = time.time() - os.path.getmtime(cache_file)
+            if age > self.cache_ttl * 24 * 60 * 60:
+                os.remove(cache_file)
+                return None
+            with open(cache_file, 'rb') as infile:
+                jresponse = _json_loads(infile.read())
+        except (OSError, ValueError):
+            return None
+
+        print(f'Using cached Overpass API response from {cache_file}')
+        return jresponse
+
+    def write_cached_response(self, cache_file, body):
+        """Store raw JSON response in cache file"""
+
+        if not cache_file:
+            return
+        # write to a temporary file first so that readers never see a partial file
+        tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_file, 'wb') as outfile:
+                outfile.write(body)
+            os.replace(tmp_file, cache_file)
+        except OSError as ex:
+            print(f'Failed to cache Overpass API response: {ex}')
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+    def perform_overpass_query(self, locations, template, timeout, dry_run):
+        """Query Overpass API for given locations and return the JSON response
+
+        Returns None if the query failed or in case of a dry run.
+        """
 
         print(f'Performing Overpass API query for {len(locations)} locations')
 
-        full_query = self.build_overpass_query(locations, query, timeout, distance)
+        full_query = self.build_overpass_query(locations, template)
         if dry_run or self.verbose > 1:
             print(f'Query:\n{full_query}')
         if dry_run:
-            return
+            return None
+
+        cache_file = self.get_cache_file(full_query)
+        jresponse = self.read_cached_response(cache_file)
+        if jresponse is not None:
+            return jresponse
 
         post_data = urllib.parse.urlencode({'data': full_query}).encode()
 
-        request = urllib.request.Request(f'{self.url}/interpreter', data=post_data)
         jresponse = None
         success = False
         for i in range(0, self.retries + 1):
+            if self.stopping.is_set():
+                return None
+
             delay = 0.1
-            try:
-                if self.verbose and i > 0:
-                    print(f'Retry {i} of {self.retries}')
+            if self.verbose and i > 0:
+                print(f'Retry {i} of {self.retries}')
 
-                t_start = time.perf_counter()
-                response = urllib.request.urlopen(request)
-                t_end = time.perf_counter()
+            t_start = time.monotonic_ns()
+            try:
+                response, body = self.send_overpass_request(post_data, timeout)
+            except (http.client.HTTPException, OSError, EOFError, zlib.error) as ex:
+                # EOFError and zlib.error are raised for truncated or corrupt gzip bodies
+                print(ex)
+                response = None
+            elapsed = (time.monotonic_ns() - t_start) / 1e9
 
+            if response is None:
+                pass
+            elif 200 == response.status:
+                print(f'Overpass API query took {elapsed:.1f} seconds')
                 try:
-                    jresponse = json.load(response)
-                    print(f'Overpass API query took {(t_end - t_start):.1f} seconds')
+                    jresponse = _json_loads(body)
+                except ValueError as ex:
+                    print(f'Failed to parse Overpass API JSON response: {ex}')
+                else:
                     if 'remark' in jresponse:
                         print(f'Remark from Overpass API: {jresponse["remark"]}')
                     else:
                         # request was successful, response was valid
                         success = True
                         break
-                except Exception as e:
-                    print(f'Failed to parse Overpass API JSON response: {ex}')
-            except urllib.error.URLError as ex:
-                t_end = time.perf_counter()
-                print(ex)
+            else:
+                print(f'HTTP Error {response.status}: {response.reason}')
                 if self.verbose > 1:
                     print('Error response body:')
-                    print(ex.fp.read().decode("utf-8"))
-                if 429 == ex.code:
+                    print(body.decode('utf-8', errors='replace'))
+                if 429 == response.status:
                     print('Too many requests, delaying next request...')
                     delay = 20
-            except http.client.ConnectionError as ex:
-                t_end = time.perf_counter()
-                print(ex)
             print(f'Querying Overpass API failed in try {i + 1}/{self.retries + 1} after '
-                f'{(t_end - t_start):.1f} seconds')
-            time.sleep(delay)
+                f'{elapsed:.1f} seconds')
+            # returns early if queries are stopped, the check above then ends the loop
+            self.stopping.wait(delay)
 
         if not success:
             print(f'Querying Overpass API failed after {self.retries + 1} tries')
             self.failure = True
+            return None
+
+        self.write_cached_response(cache_file, body)
+        return jresponse
+
+    def perform_overpass_chunk(self, chunk, num_queries, start, end, template, timeout, dry_run):
+        """Query Overpass API for a single chunk of locations"""
+
+        if self.verbose and num_queries > 1:
+            print(f'Chunk {chunk} of {num_queries} for {end-start} locations from '
+                  f'{start + 1} to {end}')
+        return self.perform_overpass_query(
+            self.locations_in[start:end], template, timeout, dry_run)
+
+    def thin_locations(self, min_meters):
+        """Drop locations closer than min_meters to the previously kept location
+
+        Consecutive track points are often only a few meters apart, so their search areas overlap
+        almost completely. Uses an equirectangular approximation which is sufficiently accurate
+        for such short distances. The first and last location are always kept.
+        """
+
+        if len(self.locations_in) < 3:
             return
 
-        self.process_overpass_response(jresponse)
+        # this loop runs once per GPX point, so keep everything in locals and only compute the
+        # cosine when a location is kept
+        min_meters_sq = min_meters * min_meters
+        first = self.locations_in[0]
+        locations = [first]
+        append = locations.append
+        prev_lat = first.lat
+        prev_lon = first.lon
+        lon_scale = math.cos(math.radians(prev_lat)) * 111320.0
+        for loc in itertools.islice(self.locations_in, 1, len(self.locations_in) - 1):
+            dx = (loc.lon - prev_lon) * lon_scale
+            dy = (loc.lat - prev_lat) * 110540.0
+            if dx * dx + dy * dy >= min_meters_sq:
+                append(loc)
+                prev_lat = loc.lat
+                prev_lon = loc.lon
+                lon_scale = math.cos(math.radians(prev_lat)) * 111320.0
+        append(self.locations_in[-1])
+
+        if self.verbose:
+            print(f'Reduced {len(self.locations_in)} locations to {len(locations)} locations '
+                  f'at least {min_meters:.1f} meters apart')
+        self.locations_in = locations
 
     def perform_overpass_queries(self, queries, timeout, distance, dry_run):
         """Perform multiple Overpass API queries for given locations via multiple chunks"""
 
+        if self.thin > 0:
+            self.thin_locations(self.thin)
+
         if self.limit <= 0:
             num_queries = 1
             chunk_size = len(self.locations_in)
@@ -313,14 +674,36 @@ class OverpassAlongGPX:
             print(f'Performing {num_queries} queries with {chunk_size} locations each '
                   f'for {len(self.locations_in)} locations in total')
 
+        template = self.build_overpass_query_template(queries, timeout, distance)
+
+        chunks = []
         for i in range(0, num_queries):
             start = i * chunk_size
             end = min(start + chunk_size, len(self.locations_in))
-            if self.verbose and num_queries > 1:
-                print(f'Chunk {i} of {num_queries} for {end-start} locations from '
-                      f'{start + 1} to {end}')
-            self.perform_overpass_query(
-                self.locations_in[start:end], queries, timeout, distance, dry_run)
+            chunks.append((i, num_queries, start, end, template, timeout, dry_run))
+
+        if self.parallel <= 1 or num_queries <= 1:
+            for chunk in chunks:
+                jresponse = self.perform_overpass_chunk(*chunk)
+                if jresponse is not None:
+                    self.process_overpass_response(jresponse)
+            return
+
+        # queries are network-bound, so overlap them in threads but process all responses in this
+        # thread, in chunk order, to keep the result deterministic
+        with ThreadPoolExecutor(max_workers=min(self.parallel, num_queries)) as executor:
+            futures = [executor.submit(self.perform_overpass_chunk, *chunk) for chunk in chunks]
+            try:
+                for future in futures:
+                    jresponse = future.result()
+                    if jresponse is not None:
+                        self.process_overpass_response(jresponse)
+            except BaseException:
+                # don't perform the remaining queries on errors or Ctrl-C and make queries which
+                # are already in flight stop after their current try instead of retrying
+                self.stopping.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
 
     def run(self, infiles, outfile, query, queryfile, title, timeout, distance, dry_run):
         """Perform all the magic"""
@@ -336,7 +719,9 @@ class OverpassAlongGPX:
         else:
             queries = [query]
 
+        self.prune_cache()
         self.perform_overpass_queries(queries, timeout, distance, dry_run)
+        self.close_connections()
 
         if dry_run:
             return
@@ -369,8 +754,23 @@ def main() -> int:
     parser.add_argument('-l', '--limit', type=int, default=0,
         help='limit number of locations per Overpass API query to perform multiple smaller '
              'queries instead of a large one (use 0 for unlimited, try 500 if requests fail)')
+    parser.add_argument('--thin', type=float, default=0,
+        help='skip locations closer than this many meters to the previous one to reduce the query '
+             'size, elements close to the edge of --distance may be missed (use 0 to keep all)')
     parser.add_argument('-r', '--retries', type=int, default=3,
         help='number of retries if call to Overpass API fails')
+    parser.add_argument('-p', '--parallel', type=int, default=1,
+        help='maximum number of Overpass API queries to perform in parallel when using --limit '
+             '(keep this low to respect the rate limit of the Overpass API instance)')
+    parser.add_argument('--coord-precision', type=int, default=6,
+        help='maximum number of decimal places of coordinates in queries and output')
+    parser.add_argument('--cache-dir', default=os.path.join(
+            os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'overpass_along_gpx'),
+        help='directory to cache Overpass API responses in')
+    parser.add_argument('--cache-ttl', type=float, default=7,
+        help='maximum age of cached Overpass API responses in days, older ones are removed')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+        help='neither use nor store cached Overpass API responses')
     parser.add_argument('-u', '--url', default='https://overpass-api.de/api/',
         help='Overpass API instance')
     parser.add_argument('--dry-run', action='store_true', default=False,
@@ -388,7 +788,24 @@ def main() -> int:
         parser.print_help()
         sys.exit(1)
 
-    ov_gpx = OverpassAlongGPX(args.url, args.limit, args.retries, args.verbose)
+    if args.parallel < 1:
+        print('error: number of parallel queries must be at least 1')
+        parser.print_help()
+        sys.exit(1)
+
+    if args.thin < 0:
+        print('error: thinning distance must not be negative')
+        parser.print_help()
+        sys.exit(1)
+
+    if args.coord_precision < 0:
+        print('error: coordinate precision must not be negative')
+        parser.print_help()
+        sys.exit(1)
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    ov_gpx = OverpassAlongGPX(args.url, args.limit, args.retries, args.verbose, args.parallel,
+        args.coord_precision, cache_dir, args.cache_ttl, args.thin)
     ov_gpx.run(args.files, args.outfile, args.query, args.queryfile, args.name,
         args.timeout, args.distance, args.dry_run)
 